@@ -1,9 +1,9 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import warnings
+import plotly.graph_objects as go
 import os
+import hashlib
 from gemini_utils import GeminiUtils
+from data_utils import load_and_clean_data, world_segment_trend, top_regions, world_composition
 
 # --- 1. Configuración General de la Página ---
 st.set_page_config(
@@ -11,88 +11,100 @@ st.set_page_config(
     page_icon="🧠",
     layout="wide",
 )
-warnings.filterwarnings('ignore')
 
 # --- 2. Lógica del Analizador de Datos ---
 
-@st.cache_data
-def load_and_clean_data(uploaded_file):
-    """Carga y limpia los datos desde un archivo CSV."""
-    try:
-        df = pd.read_csv(uploaded_file)
-        df['value'] = df['value'].astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-        df['value'] = pd.to_numeric(df['value'], errors='coerce')
-        df['value'].fillna(0, inplace=True)
-        for col in ['parameter', 'mode', 'region', 'powertrain']:
-             df[col] = df[col].astype(str)
-        df['year'] = pd.to_numeric(df['year'], errors='coerce').dropna().astype(int)
-        return df
-    except Exception as e:
-        st.error(f"Error al procesar el archivo: {e}")
-        return pd.DataFrame()
-
-def page_segment_trends(df):
+# Figuras de graph_objects memorizadas por selección
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def trends_figure(_cube, data_id, metric):
+    """Gráfico de líneas de la tendencia mundial por segmento, o None si no hay datos."""
+    segment_data = world_segment_trend(_cube, metric)
+    if segment_data.empty:
+        return None
+    fig = go.Figure([
+        go.Scattergl(x=group['year'], y=group['value'], mode='lines+markers', name=mode)
+        for mode, group in segment_data.groupby('mode', observed=True)
+    ])
+    fig.update_layout(title=f"Tendencia Mundial de '{metric}' por Segmento", xaxis_title='year', yaxis_title='value', legend_title_text='mode', uirevision='constant')
+    return fig
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def regional_figure(_cube, data_id, metric, segment):
+    """Barras horizontales con las 15 regiones principales, o None si no hay datos."""
+    regional_data = top_regions(_cube, metric, segment)
+    if regional_data.empty:
+        return None
+    fig = go.Figure(go.Bar(x=regional_data.to_numpy(), y=regional_data.index, orientation='h'))
+    fig.update_layout(title=f"Top 15 Regiones para '{segment}'", xaxis_title='value', yaxis_title='region', uirevision='constant')
+    return fig
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def composition_figure(_cube, data_id, metric, year):
+    """Gráfico de dona con el reparto mundial por segmento, o None si no hay datos."""
+    composition_data = world_composition(_cube, metric, year)
+    if composition_data.empty:
+        return None
+    fig = go.Figure(go.Pie(labels=composition_data.index, values=composition_data.to_numpy(), hole=0.3))
+    fig.update_layout(title=f"Distribución del Mercado Mundial en {year}", uirevision='constant')
+    return fig
+
+def page_segment_trends(cube, meta):
     st.header("📈 Tendencias por Segmento de Vehículo")
-    metric = st.selectbox("Selecciona la Métrica", options=sorted(df['parameter'].unique()), key='trends_metric')
-    segment_data = df[(df['region'] == 'World') & (df['parameter'] == metric) & (df['powertrain'] == 'EV') & (df['mode'] != 'EV')].groupby(['year', 'mode'])['value'].sum().reset_index()
-    if not segment_data.empty:
-        fig = px.line(segment_data, x='year', y='value', color='mode', title=f"Tendencia Mundial de '{metric}' por Segmento", markers=True)
+    metric = st.selectbox("Selecciona la Métrica", options=meta.parameters, key='trends_metric')
+    fig = trends_figure(cube, meta.data_id, metric)
+    if fig is not None:
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.warning("No hay datos mundiales para esta métrica.")
 
-def page_regional_comparison(df):
+def page_regional_comparison(cube, meta):
     st.header("🌍 Comparativa Regional por Segmento")
-    segments = sorted([m for m in df['mode'].unique() if m != 'EV'])
-    selected_segment = st.selectbox("Selecciona un Segmento", options=segments)
-    metric = st.selectbox("Selecciona la Métrica", options=sorted(df['parameter'].unique()), key='comparison_metric')
-    regional_data = df[(df['mode'] == selected_segment) & (df['parameter'] == metric) & (df['powertrain'] == 'EV') & (df['region'] != 'World')].groupby('region')['value'].sum().nlargest(15).sort_values()
-    if not regional_data.empty:
-        fig = px.bar(regional_data, x='value', y=regional_data.index, orientation='h', title=f"Top 15 Regiones para '{selected_segment}'")
+    selected_segment = st.selectbox("Selecciona un Segmento", options=meta.segments)
+    metric = st.selectbox("Selecciona la Métrica", options=meta.parameters, key='comparison_metric')
+    fig = regional_figure(cube, meta.data_id, metric, selected_segment)
+    if fig is not None:
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.warning(f"No hay datos para el segmento '{selected_segment}'.")
 
-def page_market_composition(df):
+def page_market_composition(cube, meta):
     st.header("📊 Composición del Mercado")
-    metric = st.selectbox("Selecciona la Métrica", options=[p for p in sorted(df['parameter'].unique()) if 'share' not in p], key='composition_metric')
-    year = st.slider("Selecciona un Año", min_value=int(df['year'].min()), max_value=int(df['year'].max()), value=int(df['year'].max() - 1))
-    composition_data = df[(df['year'] == year) & (df['parameter'] == metric) & (df['region'] == 'World') & (df['powertrain'] == 'EV') & (df['mode'] != 'EV')].groupby('mode')['value'].sum()
-    if not composition_data.empty:
-        fig = px.pie(composition_data, names=composition_data.index, values='value', title=f"Distribución del Mercado Mundial en {year}", hole=0.3)
+    metric = st.selectbox("Selecciona la Métrica", options=meta.volume_parameters, key='composition_metric')
+    year = st.slider("Selecciona un Año", min_value=meta.year_min, max_value=meta.year_max, value=meta.year_max - 1)
+    fig = composition_figure(cube, meta.data_id, metric, year)
+    if fig is not None:
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.warning(f"No hay datos de composición para el año {year}.")
 
-def run_analyzer(df):
-    """Ejecuta la lógica del analizador de datos usando un DataFrame."""
-    page = st.sidebar.radio("Selecciona un análisis", ["Tendencias", "Comparativa Regional", "Composición del Mercado"])
-    if page == "Tendencias": page_segment_trends(df)
-    elif page == "Comparativa Regional": page_regional_comparison(df)
-    elif page == "Composición del Mercado": page_market_composition(df)
+# Tabla de despacho: nombre del análisis -> función que dibuja la página
+PAGES = {
+    "Tendencias": page_segment_trends,
+    "Comparativa Regional": page_regional_comparison,
+    "Composición del Mercado": page_market_composition,
+}
 
-# --- 3. Lógica del Chatbot con Gemini ---
+def run_analyzer(cube, meta):
+    """Ejecuta la lógica del analizador de datos usando el cubo agregado y sus metadatos."""
+    page = st.sidebar.radio("Selecciona un análisis", list(PAGES))
+    PAGES[page](cube, meta)
 
-def run_chatbot(df=None):
-    """Ejecuta la lógica del Chatbot, usando opcionalmente un DataFrame."""
-    st.title("🤖 Chatbot con IA de Gemini")
+# --- 3. Lógica del Chatbot con Gemini ---
 
-    if df is not None:
-        st.success("¡Datos cargados! Ahora puedes hacer preguntas sobre tu archivo.")
-    else:
-        st.info("Sube un archivo en la barra lateral para poder hacer preguntas sobre tus datos.")
+@st.cache_resource
+def get_gemini():
+    """Crea el cliente de Gemini una sola vez por proceso y lo reutiliza entre reruns."""
+    return GeminiUtils()
 
-    try:
-        gemini = GeminiUtils()
-    except Exception as e:
-        st.error(f"Error al inicializar la IA de Gemini: {e}")
-        st.error("Asegúrate de que tu `GEMINI_API_KEY` está configurada en los secretos de Streamlit.")
-        return
+@st.cache_data(show_spinner=False)
+def data_context(_df, data_id):
+    """Primeras filas del archivo en Markdown, generadas una sola vez por archivo."""
+    return _df.head().to_markdown()
 
-    # Lógica del historial de chat
-    if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
-    
+@st.fragment
+def chat_panel(df, data_id):
+    """Historial y entrada del chat: enviar una pregunta solo vuelve a ejecutar este fragmento."""
     for message in st.session_state.chat_history:
         role = "Tú" if message['role'] == 'user' else "Gemini"
         with st.chat_message(role):
@@ -101,15 +113,15 @@ def run_chatbot(df=None):
     user_prompt = st.chat_input("Escribe tu pregunta aquí...")
 
     if user_prompt:
-        # Construir el prompt con contexto si hay datos
+        # Construir el prompt con contexto si hay datos que la sesión de chat aún no conoce
         final_prompt = user_prompt
-        if df is not None:
-            data_context = df.head().to_markdown()
+        send_context = df is not None and st.session_state.get('chat_data_id') != data_id
+        if send_context:
             final_prompt = f"""
             Eres un asistente de análisis de datos. Un usuario ha cargado un archivo CSV.
             Aquí tienes un resumen de las primeras filas de los datos:
             ---
-            {data_context}
+            {data_context(df, data_id)}
             ---
             Basándote en estos datos, responde a la siguiente pregunta del usuario. 
             Si la pregunta no se puede responder con los datos proporcionados, indícalo claramente.
@@ -121,14 +133,55 @@ def run_chatbot(df=None):
         with st.chat_message("Tú"):
             st.markdown(user_prompt)
 
-        with st.spinner("Gemini está pensando..."):
-            chat = gemini.model.start_chat(history=st.session_state.chat_history)
-            response = chat.send_message(final_prompt)
-            response_text = response.text
-        
-        st.session_state.chat_history.append({"role": "model", "parts": [response_text]})
+        # Mostrar la respuesta a medida que llegan los fragmentos
         with st.chat_message("Gemini"):
-            st.markdown(response_text)
+            try:
+                response = st.session_state.chat.send_message(final_prompt, stream=True)
+                response_text = st.write_stream(chunk.text for chunk in response)
+            except ValueError:
+                # chunk.text falla si el fragmento llega bloqueado (SAFETY, RECITATION) o sin texto
+                response_text = None
+                st.error("Gemini no devolvió texto para esta pregunta: la respuesta fue bloqueada o llegó vacía.")
+            except Exception as e:
+                response_text = None
+                st.error(f"Error al obtener la respuesta de Gemini: {e}")
+        if response_text is None:
+            # Una respuesta fallida deja la sesión inservible: se descarta la pregunta y se rehace
+            # la sesión con el historial válido; el contexto de datos se reenvía en el próximo turno
+            st.session_state.chat_history.pop()
+            st.session_state.chat = get_gemini().model.start_chat(history=list(st.session_state.chat_history))
+            st.session_state.pop('chat_data_id', None)
+            return
+        if send_context:
+            # El historial de la sesión ya lleva el contexto: los turnos siguientes no lo repiten
+            st.session_state.chat_data_id = data_id
+
+        st.session_state.chat_history.append({"role": "model", "parts": [response_text]})
+
+def run_chatbot(df=None, data_id=None):
+    """Ejecuta la lógica del Chatbot, usando opcionalmente un DataFrame."""
+    st.title("🤖 Chatbot con IA de Gemini")
+
+    if df is not None:
+        st.success("¡Datos cargados! Ahora puedes hacer preguntas sobre tu archivo.")
+    else:
+        st.info("Sube un archivo en la barra lateral para poder hacer preguntas sobre tus datos.")
+
+    try:
+        gemini = get_gemini()
+    except Exception as e:
+        st.error(f"Error al inicializar la IA de Gemini: {e}")
+        st.error("Asegúrate de que tu `GEMINI_API_KEY` está configurada en los secretos de Streamlit.")
+        return
+
+    # Lógica del historial de chat
+    if 'chat_history' not in st.session_state:
+        st.session_state.chat_history = []
+    # Sesión de chat persistente: evita reconstruir el historial en cada turno
+    if 'chat' not in st.session_state:
+        st.session_state.chat = gemini.model.start_chat(history=[])
+
+    chat_panel(df, data_id)
 
 # --- 4. Aplicación Principal (Router) ---
 def main():
@@ -138,13 +191,28 @@ def main():
     uploaded_file = st.sidebar.file_uploader("Sube tu archivo CSV de datos", type=["csv"], key="main_uploader")
     
     if uploaded_file:
-        df = load_and_clean_data(uploaded_file)
+        # Huella del contenido como clave de caché, calculada una vez por subida
+        if st.session_state.get('upload_file_id') != uploaded_file.file_id:
+            st.session_state['upload_file_id'] = uploaded_file.file_id
+            st.session_state['data_id'] = hashlib.blake2b(uploaded_file.getvalue()).hexdigest()
+        data_id = st.session_state['data_id']
+        df, cube, meta = load_and_clean_data(data_id, uploaded_file)
+    else:
+        df = cube = meta = None
+        for key in ('upload_file_id', 'data_id'):
+            if key in st.session_state:
+                del st.session_state[key]
+
+    if meta is not None:
         st.session_state['df'] = df
+        st.session_state['cube'] = cube
+        st.session_state['meta'] = meta
         st.session_state['data_loaded'] = True
     else:
-        # Limpiar el estado si no hay archivo
-        if 'df' in st.session_state:
-            del st.session_state['df']
+        # Limpiar el estado si no hay archivo o si no se pudo cargar
+        for key in ('df', 'cube', 'meta'):
+            if key in st.session_state:
+                del st.session_state[key]
         st.session_state['data_loaded'] = False
 
     app_choice = st.sidebar.radio(
@@ -157,13 +225,14 @@ def main():
 
     if app_choice == "Analizador de Datos":
         if df_from_session is not None:
-            run_analyzer(df_from_session)
+            run_analyzer(st.session_state['cube'], st.session_state['meta'])
         else:
             st.title("Bienvenido al Analizador de Datos")
             st.info("👈 Sube un archivo CSV en la barra lateral para comenzar.")
     
     elif app_choice == "Chatbot con Gemini":
-        run_chatbot(df_from_session)
+        meta = st.session_state.get('meta')
+        run_chatbot(df_from_session, meta.data_id if meta is not None else None)
 
 
 if __name__ == "__main__":
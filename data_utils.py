@@ -0,0 +1,176 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.feather as feather
+from typing import NamedTuple
+
+# Directorio por usuario (no compartido en /tmp) y con tamaño acotado
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'dashboard_ev')
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_VERSION = 6  # Subir al cambiar la limpieza para no reutilizar copias antiguas
+NUMBER_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+CATEGORY_COLUMNS = ['parameter', 'mode', 'region', 'powertrain']
+# Texto respaldado por Arrow; los diccionarios siguen llegando como categorías de pandas
+STRING_TYPES = {pa.string(): pd.ArrowDtype(pa.string())}.get
+
+class Meta(NamedTuple):
+    """Resumen del archivo calculado una sola vez al cargarlo."""
+    data_id: str
+    parameters: tuple
+    volume_parameters: tuple  # Sin las métricas de cuota ('share'), para la composición
+    modes: tuple
+    segments: tuple  # Modos sin 'EV', para el selector de la comparativa regional
+    year_min: int
+    year_max: int
+
+def prune_cache(keep):
+    """Borra las copias Feather más antiguas hasta que el directorio quepa en CACHE_MAX_BYTES."""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if path != keep:
+            os.remove(path)
+            total -= size
+
+def read_clean_data(data_id, uploaded_file):
+    """Lee y limpia el CSV, reutilizando la copia Feather en disco si ya existe."""
+    cache_path = os.path.join(CACHE_DIR, f"{data_id}-v{CACHE_VERSION}.feather")
+    if os.path.exists(cache_path):
+        try:
+            df = feather.read_table(cache_path).to_pandas(types_mapper=STRING_TYPES)
+            os.utime(cache_path)  # Marca de uso para el recorte por antigüedad
+            return df
+        except (OSError, pa.ArrowException):
+            # Copia dañada: se descarta y se vuelve a leer el CSV
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+
+    # Lector de PyArrow: analiza columnas en paralelo y devuelve cadenas Arrow
+    table = pv.read_csv(
+        pa.BufferReader(uploaded_file.getvalue()),
+        convert_options=pv.ConvertOptions(column_types={
+            'value': pa.string(),
+            # Baja cardinalidad: el lector las codifica como diccionario y llegan a pandas como categorías
+            **{col: pa.dictionary(pa.int32(), pa.string()) for col in CATEGORY_COLUMNS},
+        }),
+    )
+    # Kernels de Arrow sobre el búfer contiguo: quita separadores de miles y usa el punto como decimal
+    value = pc.utf8_trim_whitespace(table['value'])
+    value = pc.replace_substring(value, pattern='.', replacement='')
+    value = pc.replace_substring(value, pattern=',', replacement='.')
+    # Lo que no es un número queda nulo y después en 0
+    is_number = pc.match_substring_regex(value, pattern=NUMBER_PATTERN)
+    value = pc.if_else(is_number, value, pa.scalar(None, pa.string()))
+    # float32 basta para estos valores y reduce a la mitad los bytes que recorre cada suma
+    value = pc.fill_null(pc.cast(value, pa.float32()), 0)
+    table = table.set_column(table.schema.get_field_index('value'), 'value', value)
+    # Única conversión a pandas: cadenas respaldadas por Arrow, números como arreglos de NumPy
+    df = table.to_pandas(types_mapper=STRING_TYPES)
+    # Categorías en orden alfabético
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    # Se descartan las filas con año no numérico
+    year = pd.to_numeric(df['year'], errors='coerce').astype('float64')
+    df = df.assign(year=year).dropna(subset=['year']).astype({'year': 'int16'})
+
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        # Escribir en un temporal y renombrar: nunca queda un archivo a medias en la ruta final
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        os.close(fd)
+        feather.write_feather(df, tmp_path, compression='zstd')
+        os.replace(tmp_path, cache_path)
+        prune_cache(keep=cache_path)
+    except (OSError, pa.ArrowException):
+        # Sin disco escribible basta con la caché en memoria de Streamlit
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
+
+@st.cache_data
+def load_and_clean_data(data_id, _uploaded_file):
+    """Carga y limpia los datos desde un archivo CSV identificado por su huella."""
+    try:
+        df = read_clean_data(data_id, _uploaded_file)
+        # Cubo pre-agregado y ordenado de las filas 'EV' (las únicas que grafican las páginas)
+        # Sumas en float64: float32 redondea totales por encima de 2**24
+        ev = df[df['powertrain'] == 'EV'].astype({'value': 'float64'})
+        cube = ev.groupby(['parameter', 'region', 'mode', 'year'], observed=True)['value'].sum().sort_index()
+        # Opciones de los widgets: una vez por archivo, leídas de las categorías ya ordenadas
+        years = df['year'].to_numpy()
+        parameters = tuple(df['parameter'].cat.categories)
+        modes = tuple(df['mode'].cat.categories)
+        meta = Meta(
+            data_id=data_id,
+            parameters=parameters,
+            volume_parameters=tuple(p for p in parameters if 'share' not in p),
+            modes=modes,
+            segments=tuple(m for m in modes if m != 'EV'),
+            year_min=int(np.nanmin(years)),
+            year_max=int(np.nanmax(years)),
+        )
+        return df, cube, meta
+    except Exception as e:
+        st.error(f"Error al procesar el archivo: {e}")
+        return pd.DataFrame(), pd.Series(dtype='float64'), None
+
+def select_rows(cube, key, levels=('parameter', 'region')):
+    """Devuelve la sección del cubo para la clave dada, o una serie vacía si no existe."""
+    try:
+        return cube.xs(key, level=levels)
+    except KeyError:
+        return cube.iloc[0:0]
+
+def top_k(s, k):
+    """Devuelve los k mayores valores de la serie, ordenados de menor a mayor."""
+    vals = s.to_numpy()
+    k = min(k, vals.size)
+    if k == 0:
+        return s
+    # Selección parcial O(n) en lugar de ordenar todas las regiones
+    idx = np.argpartition(-vals, k - 1)[:k]
+    # Ordenar solo los k sobrevivientes y armar la serie sin pasar por sort_values
+    order = idx[np.argsort(vals[idx])]
+    return pd.Series(vals[order], index=s.index[order], name=s.name)
+
+def group_sum(s, level):
+    """Suma la serie por un nivel del índice acumulando sobre sus códigos enteros."""
+    pos = s.index.names.index(level)
+    codes, labels = s.index.codes[pos], s.index.levels[pos]
+    # np.bincount recorre los códigos una vez en C, sin tabla hash de etiquetas
+    sums = np.bincount(codes, weights=s.to_numpy(dtype='float64'), minlength=len(labels))
+    present = np.bincount(codes, minlength=len(labels)) > 0
+    return pd.Series(sums[present], index=labels[present], name=s.name)
+
+# Consultas por gráfica sobre el cubo; las memoriza la figura que las usa
+
+def world_segment_trend(cube, metric):
+    """Suma mundial por año y segmento para la métrica dada."""
+    # El cubo ya está ordenado por segmento y año, como necesita la gráfica
+    world = select_rows(cube, (metric, 'World'))
+    return world.drop('EV', level='mode', errors='ignore').reset_index()
+
+def top_regions(cube, metric, segment, k=15):
+    """Las k regiones (sin 'World') con mayor valor para el segmento y la métrica."""
+    regional = select_rows(cube, (metric, segment), levels=('parameter', 'mode'))
+    regional = regional.drop('World', level='region', errors='ignore')
+    return top_k(group_sum(regional, 'region'), k)
+
+def world_composition(cube, metric, year):
+    """Reparto mundial por segmento para la métrica y el año dados."""
+    world = select_rows(cube, (metric, 'World', year), levels=('parameter', 'region', 'year'))
+    return world.drop('EV', errors='ignore')
@@ -18,7 +18,7 @@ class GeminiUtils:
         self.model = self._get_available_model()
     
     def _get_available_model(self):
-        """Obtiene el primer modelo disponible de la lista"""
+        """Obtiene el primer modelo de la lista que la cuenta tenga disponible"""
         # Modelos actualizados y disponibles en 2025
         modelos_disponibles = [
             "gemini-2.0-flash-exp",  # Modelo experimental más reciente
@@ -28,14 +28,23 @@ class GeminiUtils:
             "gemini-1.5-pro",          # Modelo pro básico
         ]
         
-        for modelo in modelos_disponibles:
-            try:
-                model = genai.GenerativeModel(modelo)
-                logger.info(f"Modelo {modelo} inicializado correctamente")
-                return model
-            except Exception as e:
-                logger.warning(f"Modelo {modelo} no disponible: {e}")
-                continue
+        # Una sola consulta a la API en lugar de probar cada modelo por separado
+        try:
+            modelos_cuenta = {
+                m.name.split('/')[-1]
+                for m in genai.list_models()
+                if 'generateContent' in m.supported_generation_methods
+            }
+        except Exception as e:
+            # Sin la lista no hay nada que comprobar: directo al modelo fallback
+            logger.warning(f"No se pudo consultar la lista de modelos: {e}")
+        else:
+            for modelo in modelos_disponibles:
+                if modelo in modelos_cuenta:
+                    model = genai.GenerativeModel(modelo)
+                    logger.info(f"Modelo {modelo} inicializado correctamente")
+                    return model
+                logger.warning(f"Modelo {modelo} no disponible")
         
         # Fallback a modelo básico si ninguno funciona
         try: